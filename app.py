@@ -1,14 +1,27 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson が入っていない環境では標準ライブラリで代用する
+    from json import loads as json_loads
+import numpy as np
 import pandas as pd
 import io  # ← 追加
 import time
 import datetime
 import plotly.express as px
+import plotly.graph_objects as go
 import pytz
 from streamlit_autorefresh import st_autorefresh
 from datetime import timedelta
 import logging
+import bisect
+import math
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from dataclasses import dataclass
 
 
 
@@ -20,6 +33,33 @@ st.set_page_config(
 )
 
 HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+@st.cache_resource
+def get_session():
+    """
+    全APIリクエストで共有するセッションを返す。
+    スクリプトの再実行をまたいで同じインスタンスを使い回し、接続（keep-alive）を再利用する。
+    一時的なゲートウェイエラー（502/503/504）は短い間隔で2回まで再試行する。
+    接続・読み込みのタイムアウトは再試行せず、自動更新の間隔を超えて待たないようにする。
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    retries = Retry(total=2, connect=0, read=0, status=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retries))
+    return session
+
+SESSION = get_session()
+
+@st.cache_resource
+def get_executor():
+    """
+    API取得を並列に行うためのスレッドプールを返す。
+    セッションと同様にスクリプトの再実行をまたいで共有する。
+    """
+    return ThreadPoolExecutor(max_workers=32)
+
+EXECUTOR = get_executor()
+
 JST = pytz.timezone('Asia/Tokyo')
 ROOM_LIST_URL = "https://mksoul-pro.com/showroom/file/room_list.csv"  #認証用
 
@@ -27,54 +67,107 @@ if "authenticated" not in st.session_state:  #認証用
     st.session_state.authenticated = False  #認証用
 
 
-@st.cache_data(ttl=3600)
+def get_total_pages(data, page, page_size):
+    """
+    ページングAPIの応答に含まれるメタ情報から総ページ数を求める。
+    (total_page / last_page / total_entries / next_page を参照し、判別できない場合は None を返す)
+    """
+    if not isinstance(data, dict):
+        return None
+    for key in ('total_page', 'total_pages', 'last_page'):
+        if isinstance(data.get(key), int) and data[key] > 0:
+            return data[key]
+    total_entries = data.get('total_entries')
+    per_page = data.get('entries_per_pages') or page_size
+    if isinstance(total_entries, int) and isinstance(per_page, int) and per_page > 0:
+        return max(1, math.ceil(total_entries / per_page))
+    if 'next_page' in data and not data['next_page']:
+        return page
+    return None
+
+
+def pick_list(data, keys):
+    """
+    APIの応答からリスト部分を取り出す。
+    辞書なら keys のうち最初に見つかったキーの値、リストならそのまま、それ以外は空リストを返す。
+    """
+    if isinstance(data, dict):
+        return next((data[key] for key in keys if key in data), [])
+    if isinstance(data, list):
+        return data
+    return []
+
+
+def get_event_page(status, page):
+    """
+    イベント検索APIの1ページ分を取得し、(イベントのリスト, 総ページ数または None) を返す。
+    ワーカースレッドから呼び出されるため、例外はそのまま送出する。
+    """
+    url = f"https://www.showroom-live.com/api/event/search?status={status}&page={page}"
+    response = SESSION.get(url, timeout=5)
+    response.raise_for_status()
+    data = json_loads(response.content)
+    page_events = pick_list(data, ('events', 'event_list'))
+    return page_events, get_total_pages(data, page, len(page_events))
+
+
+def fetch_event_pages(statuses, max_pages=10):
+    """
+    複数ステータスのイベント検索ページをまとめて取得し、{status: ページ順に並んだ Future のリスト} を返す。
+    各ステータスの1ページ目を並列に取得し、メタ情報から総ページ数が分かれば必要なページだけを追加で取得する。
+    """
+    first_page_futures = {status: EXECUTOR.submit(get_event_page, status, 1) for status in statuses}
+    page_futures = {}
+    for status, future in first_page_futures.items():
+        page_futures[status] = [future]
+        if future.exception() is not None:
+            continue
+        _, total_pages = future.result()
+        last_page = min(total_pages or max_pages, max_pages)
+        page_futures[status] += [EXECUTOR.submit(get_event_page, status, page) for page in range(2, last_page + 1)]
+    return page_futures
+
+
+# イベント一覧で実際に使う項目（画像や説明文などはキャッシュに持たない）
+EVENT_FIELDS = ('event_id', 'event_name', 'event_url_key', 'started_at', 'ended_at', 'is_closed')
+
+# キャッシュのTTLはデータの更新頻度に合わせて設定する
+#   イベント一覧: 6時間 / 参加ルームのランキング: 5分 / 配信状況: 10秒 / 各ルームの順位・ポイント: 4秒
+@st.cache_data(ttl=21600)
 def get_events():
     """
     開催中および終了済みのイベントリストを取得する。
     終了済みイベントには "＜終了＞" という接頭辞を付ける。
+    取得に失敗した結果を長時間キャッシュしないよう、例外はそのまま送出して main() で表示する。
     """
     all_events = []
-    # status=1 (開催中) と status=4 (終了済み) の両方を取得
+    # status=1 (開催中) と status=4 (終了済み) の両方を、各ステータス最大10ページまでまとめて取得
+    page_futures = fetch_event_pages([1, 4])
     for status in [1, 4]:
-        page = 1
-        # 各ステータスで最大10ページまで取得
-        for _ in range(10):
-            url = f"https://www.showroom-live.com/api/event/search?status={status}&page={page}"
-            try:
-                response = requests.get(url, headers=HEADERS, timeout=5)
-                response.raise_for_status()
-                data = response.json()
-                
-                page_events = []
-                if isinstance(data, dict):
-                    if 'events' in data:
-                        page_events = data['events']
-                    elif 'event_list' in data:
-                        page_events = data['event_list']
-                elif isinstance(data, list):
-                    page_events = data
-
-                if not page_events:
-                    break  # イベントがなくなったらループを抜ける
-
-                # 既存のフィルタリングロジックを適用
-                filtered_page_events = [
-                    event for event in page_events 
-                    if event.get("show_ranking") is not False and event.get("is_event_block") is not True
-                ]
-                
-                # 終了済みイベントの場合、イベント名に接頭辞を追加
-                if status == 4:
-                    for event in filtered_page_events:
-                        event['event_name'] = f"＜終了＞ {event['event_name']}"
-
-                all_events.extend(filtered_page_events)
-                page += 1
-            except requests.exceptions.RequestException as e:
-                st.error(f"イベントデータ取得中にエラーが発生しました (status={status}): {e}")
-                break
-            except ValueError:
-                st.error(f"APIからのJSONデコードに失敗しました: {response.text}")
+        page_size = None
+        for future in page_futures[status]:
+            page_events, _ = future.result()
+            if not page_events:
+                break  # イベントがなくなったらループを抜ける
+
+            # 既存のフィルタリングロジックを適用し、必要な項目だけを残す
+            filtered_page_events = [
+                {key: event[key] for key in EVENT_FIELDS if key in event}
+                for event in page_events
+                if event.get("show_ranking") is not False and not event.get("is_event_block")
+            ]
+            
+            # 終了済みイベントの場合、イベント名に接頭辞を追加
+            if status == 4:
+                for event in filtered_page_events:
+                    event['event_name'] = f"＜終了＞ {event['event_name']}"
+
+            all_events.extend(filtered_page_events)
+
+            # 1ページ目より件数が少ないページは最終ページなので、以降のページは読まない
+            if page_size is None:
+                page_size = len(page_events)
+            elif len(page_events) < page_size:
                 break
     return all_events
 
@@ -84,34 +177,88 @@ RANKING_API_CANDIDATES = [
     "https://www.showroom-live.com/api/event/ranking?event_id={event_id}&page={page}",
 ]
 
+# ランキングの各エントリで実際に使う項目
+RANKING_FIELDS = ('room_id', 'room_name', 'user_name', 'rank', 'point')
+
+def get_ranking_page(url, page):
+    """
+    ランキングAPIの1ページ分を取得し、(ランキングのリスト, 総ページ数または None) を返す。
+    各エントリは RANKING_FIELDS の項目だけに絞る。
+    404の場合はリストが None になる。ワーカースレッドから呼び出されるため、例外はそのまま送出する。
+    """
+    response = SESSION.get(url, timeout=10)
+    if response.status_code == 404:
+        return None, None
+    response.raise_for_status()
+    data = json_loads(response.content)
+    ranking_list = pick_list(data, ('ranking', 'event_list'))
+    if ranking_list:
+        ranking_list = [{key: r[key] for key in RANKING_FIELDS if key in r} for r in ranking_list if isinstance(r, dict)]
+    return ranking_list, get_total_pages(data, page, len(ranking_list or []))
+
+@st.cache_resource
+def get_ranking_url_cache():
+    """イベントIDごとに、ランキングを取得できたURLテンプレートを保持する"""
+    return {}
+
+def get_ranking_pages(base_url, event_url_key, event_id, pages, page_size):
+    """
+    指定ページを並列に取得し、空のページ（または404）が出るまでのランキングを連結して返す。
+    page_size（1ページ目の件数）より少ないページは最終ページとみなし、以降は読まない。
+    例外はそのまま送出する。
+    """
+    futures = [
+        EXECUTOR.submit(get_ranking_page, base_url.format(event_url_key=event_url_key, event_id=event_id, page=page), page)
+        for page in pages
+    ]
+    ranking_data = []
+    for future in futures:
+        ranking_list, _ = future.result()
+        if not ranking_list:
+            break
+        ranking_data.extend(ranking_list)
+        if len(ranking_list) < page_size:
+            break
+    return ranking_data
+
+def find_event_ranking(candidates, event_url_key, event_id, max_pages):
+    """
+    各候補URLの1ページ目を並列に取得し、room_id を含む最初の候補についてのみ残りのページを取得する。
+    残りのページは、1ページ目のメタ情報から総ページ数が分かればその分だけ取得する。
+    採用した候補で全ページを取得できた時点で、まだ始まっていない他候補の取得は取り消す。
+    (採用したURLテンプレート, ランキングデータ) を返す。見つからなければ (None, [])。
+    """
+    futures = [
+        EXECUTOR.submit(get_ranking_page, base_url.format(event_url_key=event_url_key, event_id=event_id, page=1), 1)
+        for base_url in candidates
+    ]
+    for base_url, future in zip(candidates, futures):
+        try:
+            first_page, total_pages = future.result()
+            if not first_page or not any('room_id' in r for r in first_page):
+                continue
+            last_page = min(total_pages or max_pages, max_pages)
+            rest = get_ranking_pages(base_url, event_url_key, event_id, range(2, last_page + 1), len(first_page))
+            # 残りのページの取得に失敗した場合は次の候補を試すため、取り消しは成功した後に行う
+            for other in futures:
+                other.cancel()
+            return base_url, first_page + rest
+        except (requests.exceptions.RequestException, ValueError):
+            continue
+    return None, []
+
 @st.cache_data(ttl=300)
 def get_event_ranking_with_room_id(event_url_key, event_id, max_pages=10):
+    url_cache = get_ranking_url_cache()
     all_ranking_data = []
-    for base_url in RANKING_API_CANDIDATES:
-        try:
-            temp_ranking_data = []
-            for page in range(1, max_pages + 1):
-                url = base_url.format(event_url_key=event_url_key, event_id=event_id, page=page)
-                response = requests.get(url, headers=HEADERS, timeout=10)
-                if response.status_code == 404:
-                    break
-                response.raise_for_status()
-                data = response.json()
-                ranking_list = None
-                if isinstance(data, dict) and 'ranking' in data:
-                    ranking_list = data['ranking']
-                elif isinstance(data, dict) and 'event_list' in data:
-                    ranking_list = data['event_list']
-                elif isinstance(data, list):
-                    ranking_list = data
-                if not ranking_list:
-                    break
-                temp_ranking_data.extend(ranking_list)
-            if temp_ranking_data and any('room_id' in r for r in temp_ranking_data):
-                all_ranking_data = temp_ranking_data
-                break
-        except requests.exceptions.RequestException:
-            continue
+    # 前回取得できたURLがあればそれだけを試し、だめな場合に全候補を探索する
+    cached_url = url_cache.get(event_id)
+    candidate_groups = [[cached_url], RANKING_API_CANDIDATES] if cached_url else [RANKING_API_CANDIDATES]
+    for candidates in candidate_groups:
+        base_url, all_ranking_data = find_event_ranking(candidates, event_url_key, event_id, max_pages)
+        if base_url:
+            url_cache[event_id] = base_url
+            break
     if not all_ranking_data:
         return None
     room_map = {}
@@ -127,129 +274,338 @@ def get_event_ranking_with_room_id(event_url_key, event_id, max_pages=10):
     return room_map
 
 def get_room_event_info(room_id):
+    # ワーカースレッドから呼び出されるため、ここでは st.* を使わずに例外をそのまま送出する
     url = f"https://www.showroom-live.com/api/room/event_and_support?room_id={room_id}"
-    try:
-        response = requests.get(url, headers=HEADERS, timeout=5)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        # このエラーはmain()でキャッチし、よりユーザーフレンドリーなメッセージを表示する
-        st.error(f"ルームID {room_id} のデータ取得中にエラーが発生しました: {e}")
+    response = SESSION.get(url, timeout=5)
+    response.raise_for_status()
+    return json_loads(response.content)
+
+def extract_rank_info(room_info):
+    """ルームのイベント情報から順位・ポイント情報（ranking）を取り出す。見つからなければ None を返す"""
+    rank_info = None
+    if 'ranking' in room_info and isinstance(room_info['ranking'], dict):
+        rank_info = room_info['ranking']
+    elif 'event_and_support_info' in room_info and isinstance(room_info['event_and_support_info'], dict):
+        event_info = room_info['event_and_support_info']
+        if 'ranking' in event_info and isinstance(event_info['ranking'], dict):
+            rank_info = event_info['ranking']
+    elif 'event' in room_info and isinstance(room_info['event'], dict):
+        event_data = room_info['event']
+        if 'ranking' in event_data and isinstance(event_data['ranking'], dict):
+            rank_info = event_data['ranking']
+    return rank_info
+
+@dataclass(slots=True)
+class RoomStatus:
+    """ルームの現在の順位・ポイント情報（APIに値がない項目は None）"""
+    rank: int | None
+    point: int | None
+    upper_gap: int | None
+    lower_gap: int | None
+
+def get_room_status(room_id):
+    """
+    ルームのイベント情報を取得し、(rank, point, upper_gap, lower_gap) のタプルで返す。
+    st.cache_data の戻り値になるため、スクリプト内で定義したクラスではなくタプルにしておく。
+    ランキング情報が含まれていない場合は None を返す。
+    ワーカースレッドから呼び出されるため、例外はそのまま送出する。
+    """
+    room_info = get_room_event_info(room_id)
+    if not isinstance(room_info, dict):
+        raise ValueError("データが不正な形式です")
+    rank_info = extract_rank_info(room_info)
+    if not rank_info or 'point' not in rank_info:
         return None
+    return (rank_info.get('rank'), rank_info.get('point'), rank_info.get('upper_gap'), rank_info.get('lower_gap'))
 
-@st.cache_data(ttl=30)
-def get_gift_list(room_id):
+@st.cache_data(ttl=4)
+def get_rooms_bulk(room_ids):
+    """
+    複数ルームの順位・ポイント情報を並列に取得し、{room_id: get_room_status のタプルまたは None} の辞書で返す。
+    room_ids はソート済みのタプルを渡すこと（同じ組み合わせならキャッシュが再利用される）。
+    取得に失敗したルームは辞書に含めず、他のルームの結果には影響しない。
+    """
+    room_statuses = {}
+    futures = {room_id: EXECUTOR.submit(get_room_status, room_id) for room_id in room_ids}
+    for room_id, future in futures.items():
+        try:
+            room_statuses[room_id] = future.result()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # このエラーはmain()でキャッチし、よりユーザーフレンドリーなメッセージを表示する
+            st.error(f"ルームID {room_id} のデータ取得中にエラーが発生しました: {e}")
+    return room_statuses
+
+def get_room_statuses(room_ids):
+    """
+    get_rooms_bulk の結果を {room_id: RoomStatus または None} の辞書に変換して返す。
+    RoomStatus はスクリプトの再実行ごとに定義し直されるため、キャッシュの外で組み立てる。
+    """
+    return {
+        room_id: RoomStatus(*status) if status is not None else None
+        for room_id, status in get_rooms_bulk(room_ids).items()
+    }
+
+def request_gift_list(room_id):
+    # ワーカースレッドから呼び出されるため、例外はそのまま送出する
     url = f"https://www.showroom-live.com/api/live/gift_list?room_id={room_id}"
-    try:
-        response = requests.get(url, headers=HEADERS, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        gift_list_map = {}
-        for gift in data.get('normal', []) + data.get('special', []):
-            try:
-                point_value = int(gift.get('point', 0))
-            except (ValueError, TypeError):
-                point_value = 0
-            gift_list_map[str(gift['gift_id'])] = {
-                'name': gift.get('gift_name', 'N/A'),
-                'point': point_value,
-                'image': gift.get('image', '')
-            }
-        return gift_list_map
-    except requests.exceptions.RequestException as e:
-        st.error(f"ルームID {room_id} のギフトリスト取得中にエラーが発生しました: {e}")
-        return {}
+    response = SESSION.get(url, timeout=5)
+    response.raise_for_status()
+    data = json_loads(response.content)
+    gift_list_map = {}
+    for gift in chain(data.get('normal', ()), data.get('special', ())):
+        try:
+            point_value = int(gift.get('point', 0))
+        except (ValueError, TypeError):
+            point_value = 0
+        # ギフトログのgift_idは整数なので、整数キーでそのまま引けるようにする
+        gift_list_map[int(gift['gift_id'])] = {
+            'name': gift.get('gift_name', 'N/A'),
+            'point': point_value,
+            'image': gift.get('image', '')
+        }
+    return gift_list_map
+
+GIFT_LIST_TTL = 30
+
+@st.cache_resource
+def get_gift_list_cache():
+    """ルームIDごとに (取得時刻, ギフトリスト) を保持する（全セッションで共有）"""
+    return {}
+
+def get_gift_lists(room_ids):
+    """
+    複数ルームのギフトリストを {room_id: ギフトリスト} の辞書で返す。
+    キャッシュはルームごとに GIFT_LIST_TTL 秒保持し、期限切れ・未取得のルームだけを並列に取得する。
+    取得に失敗したルームは空の辞書になる（失敗はキャッシュしない）。
+    """
+    cache = get_gift_list_cache()
+    now = time.time()
+    gift_lists = {}
+    futures = {}
+    for room_id in room_ids:
+        fetched_at, gift_list_map = cache.get(room_id, (0, None))
+        if gift_list_map is not None and now - fetched_at <= GIFT_LIST_TTL:
+            gift_lists[room_id] = gift_list_map
+        else:
+            futures[room_id] = EXECUTOR.submit(request_gift_list, room_id)
+    if not futures:
+        return gift_lists
+    # 取得し直すついでに、期限切れのルームのギフトリストを捨てる
+    for room_id in [room_id for room_id, (fetched_at, _) in list(cache.items()) if now - fetched_at > GIFT_LIST_TTL]:
+        cache.pop(room_id, None)
+    for room_id, future in futures.items():
+        try:
+            gift_lists[room_id] = future.result()
+            cache[room_id] = (time.time(), gift_lists[room_id])
+        except (requests.exceptions.RequestException, ValueError) as e:
+            st.error(f"ルームID {room_id} のギフトリスト取得中にエラーが発生しました: {e}")
+            gift_lists[room_id] = {}
+    return gift_lists
 
 if "gift_log_cache" not in st.session_state:
     st.session_state.gift_log_cache = {}
 
-def get_and_update_gift_log(room_id):
+def request_gift_log(room_id):
+    # ワーカースレッドから呼び出されるため、例外はそのまま送出する
     url = f"https://www.showroom-live.com/api/live/gift_log?room_id={room_id}"
-    try:
-        response = requests.get(url, headers=HEADERS, timeout=5)
-        response.raise_for_status()
-        new_gift_log = response.json().get('gift_log', [])
-        
-        if room_id not in st.session_state.gift_log_cache:
-            st.session_state.gift_log_cache[room_id] = []
-        
-        existing_log = st.session_state.gift_log_cache[room_id]
-        
-        if new_gift_log:
-            existing_log_set = {(log.get('gift_id'), log.get('created_at'), log.get('num')) for log in existing_log}
-            
-            for log in new_gift_log:
-                log_key = (log.get('gift_id'), log.get('created_at'), log.get('num'))
-                if log_key not in existing_log_set:
-                    existing_log.append(log)
-        
-        st.session_state.gift_log_cache[room_id].sort(key=lambda x: x.get('created_at', 0), reverse=True)
-        
-        return st.session_state.gift_log_cache[room_id]
-        
-    except requests.exceptions.RequestException as e:
-        st.warning(f"ルームID {room_id} のギフトログ取得中にエラーが発生しました。配信中か確認してください: {e}")
-        return st.session_state.gift_log_cache.get(room_id, [])
+    response = SESSION.get(url, timeout=5)
+    response.raise_for_status()
+    return json_loads(response.content).get('gift_log', [])
 
-def get_onlives_rooms():
+GIFT_LOG_MAX_ENTRIES = 5000
+
+def gift_log_fingerprint(log):
+    """
+    ギフトログ1件の重複判定用のキーを返す。
+    (gift_id, created_at, num) を重ならないビット幅（num は下位32ビット、created_at はその上の64ビット）で
+    1つの整数に詰める。値が欠けている・範囲外の場合は、取りこぼさないよう元のタプルをそのまま使う。
+    """
+    gift_id, created_at, num = log.get('gift_id'), log.get('created_at'), log.get('num')
+    if (isinstance(gift_id, int) and isinstance(created_at, int) and isinstance(num, int)
+            and gift_id >= 0 and 0 <= created_at < 1 << 64 and 0 <= num < 1 << 32):
+        return (gift_id << 96) | (created_at << 32) | num
+    return (gift_id, created_at, num)
+
+def update_gift_log(room_id, new_gift_log):
+    """
+    取得したギフトログをセッションのキャッシュにマージし、新しい順に並べたログを返す。
+    キャッシュは {'fps': 取り込み済みログの重複判定キーの集合, 'log': 新しい順のログ} の形で保持し、
+    新しいエントリだけを並び順を保ったまま挿入する（全体の再ソートはしない）。
+    """
+    if room_id not in st.session_state.gift_log_cache:
+        st.session_state.gift_log_cache[room_id] = {'fps': set(), 'log': []}
+    
+    cache = st.session_state.gift_log_cache[room_id]
+    fps, existing_log = cache['fps'], cache['log']
+    
+    for log in new_gift_log:
+        fp = gift_log_fingerprint(log)
+        if fp not in fps:
+            fps.add(fp)
+            bisect.insort(existing_log, log, key=lambda x: -(x.get('created_at') or 0))
+    
+    # 長時間の配信でもメモリを使い続けないよう、古いログから切り捨て、その重複判定キーも合わせて捨てる
+    for log in existing_log[GIFT_LOG_MAX_ENTRIES:]:
+        fps.discard(gift_log_fingerprint(log))
+    del existing_log[GIFT_LOG_MAX_ENTRIES:]
+    
+    return existing_log
+
+def get_and_update_gift_logs(room_ids):
+    """
+    複数ルームのギフトログを並列に取得してキャッシュを更新し、{room_id: ギフトログ} の辞書で返す。
+    取得に失敗したルームはキャッシュ済みのログを返す。
+    """
+    gift_logs = {}
+    futures = {room_id: EXECUTOR.submit(request_gift_log, room_id) for room_id in room_ids}
+    for room_id, future in futures.items():
+        try:
+            gift_logs[room_id] = update_gift_log(room_id, future.result())
+        except (requests.exceptions.RequestException, ValueError) as e:
+            st.warning(f"ルームID {room_id} のギフトログ取得中にエラーが発生しました。配信中か確認してください: {e}")
+            gift_logs[room_id] = st.session_state.gift_log_cache.get(room_id, {}).get('log', [])
+    return gift_logs
+
+def request_onlives_rooms():
+    # ワーカースレッドから呼び出されるため、例外はそのまま送出する
     onlives = {}
-    try:
-        url = "https://www.showroom-live.com/api/live/onlives"
-        response = requests.get(url, headers=HEADERS, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        all_lives = []
-        if isinstance(data, dict):
-            if 'onlives' in data and isinstance(data['onlives'], list):
-                for genre_group in data['onlives']:
-                    if 'lives' in genre_group and isinstance(genre_group['lives'], list):
-                        all_lives.extend(genre_group['lives'])
-            for live_type in ['official_lives', 'talent_lives', 'amateur_lives']:
-                if live_type in data and isinstance(data.get(live_type), list):
-                    all_lives.extend(data[live_type])
-        for room in all_lives:
-            room_id = None
-            started_at = None
-            premium_room_type = 0
-            if isinstance(room, dict):
-                room_id = room.get('room_id')
-                started_at = room.get('started_at')
-                premium_room_type = room.get('premium_room_type', 0)
-                if room_id is None and 'live_info' in room and isinstance(room['live_info'], dict):
-                    room_id = room['live_info'].get('room_id')
-                    started_at = room['live_info'].get('started_at')
-                    premium_room_type = room['live_info'].get('premium_room_type', 0)
-                if room_id is None and 'room' in room and isinstance(room['room'], dict):
-                    room_id = room['room'].get('room_id')
-                    started_at = room['room'].get('started_at')
-                    premium_room_type = room['room'].get('premium_room_type', 0)
-            if room_id and started_at is not None:
-                try:
-                    onlives[int(room_id)] = {'started_at': started_at, 'premium_room_type': premium_room_type}
-                except (ValueError, TypeError):
-                    continue
-    except requests.exceptions.RequestException as e:
-        st.warning(f"配信情報取得中にエラーが発生しました: {e}")
-    except (ValueError, AttributeError):
-        st.warning("配信情報のJSONデコードまたは解析に失敗しました。")
+    url = "https://www.showroom-live.com/api/live/onlives"
+    response = SESSION.get(url, timeout=5)
+    response.raise_for_status()
+    data = json_loads(response.content)
+    all_lives = []
+    if isinstance(data, dict):
+        if 'onlives' in data and isinstance(data['onlives'], list):
+            for genre_group in data['onlives']:
+                if 'lives' in genre_group and isinstance(genre_group['lives'], list):
+                    all_lives.extend(genre_group['lives'])
+        for live_type in ['official_lives', 'talent_lives', 'amateur_lives']:
+            if live_type in data and isinstance(data.get(live_type), list):
+                all_lives.extend(data[live_type])
+    for room in all_lives:
+        if not isinstance(room, dict):
+            continue
+        # room_id を持つ階層（ルームそのもの / live_info / room の順）から配信情報を読む
+        node = next(
+            (n for n in (room, room.get('live_info'), room.get('room')) if isinstance(n, dict) and n.get('room_id')),
+            None
+        )
+        if node is None or node.get('started_at') is None:
+            continue
+        try:
+            onlives[int(node['room_id'])] = {
+                'started_at': node['started_at'], 'premium_room_type': node.get('premium_room_type', 0)
+            }
+        except (ValueError, TypeError):
+            continue
     return onlives
 
+def is_onlives_stale():
+    """前回の配信中ルーム情報の取得から10秒以上経過しているかを返す"""
+    return time.time() - st.session_state.get("onlives_ts", 0) > 10
+
+def prefetch_onlives_rooms():
+    """
+    配信中ルームの情報の取り直しが必要なら、バックグラウンドで取得を開始しておく。
+    結果は get_onlives_rooms() で受け取る。
+    """
+    if is_onlives_stale() and "onlives_future" not in st.session_state:
+        st.session_state.onlives_future = EXECUTOR.submit(request_onlives_rooms)
+
+def get_onlives_rooms():
+    """
+    配信中ルームの情報を返す。
+    結果はセッションに保持し、前回の取得から10秒以上経過した場合のみAPIから取り直す。
+    prefetch_onlives_rooms() で取得を開始していれば、その結果を待って使う。
+    """
+    future = st.session_state.pop("onlives_future", None)
+    if is_onlives_stale():
+        onlives = {}
+        try:
+            onlives = future.result() if future else request_onlives_rooms()
+        except requests.exceptions.RequestException as e:
+            st.warning(f"配信情報取得中にエラーが発生しました: {e}")
+        except (ValueError, AttributeError):
+            st.warning("配信情報のJSONデコードまたは解析に失敗しました。")
+        st.session_state.onlives = onlives
+        st.session_state.onlives_ts = time.time()
+    return st.session_state.onlives
+
+RANK_COLORS = tuple(px.colors.qualitative.Plotly)
+# 1位〜256位の色をあらかじめ並べておき、順位からそのまま引けるようにする
+PRECOMPUTED_RANK_COLORS = tuple(RANK_COLORS[i % len(RANK_COLORS)] for i in range(256))
+
 def get_rank_color(rank):
     """
     ランキングに応じたカラーコードを返す
     Plotlyのデフォルトカラーを参考に設定
     """
-    colors = px.colors.qualitative.Plotly
-    if rank is None:
-        return "#A9A9A9"  # DarkGray
-    try:
+    # 順位は DataFrame 由来の整数か浮動小数点数（欠損は NaN）なので、例外処理ではなく型で判定する
+    if isinstance(rank, (int, np.integer)):
         rank_int = int(rank)
-        if rank_int <= 0:
-            return colors[0]
-        return colors[(rank_int - 1) % len(colors)]
-    except (ValueError, TypeError):
-        return "#A9A9A9"
+    elif isinstance(rank, (float, np.floating)) and math.isfinite(rank):
+        rank_int = int(rank)
+    else:
+        return "#A9A9A9"  # DarkGray
+    if rank_int <= 0:
+        return RANK_COLORS[0]
+    if rank_int <= len(PRECOMPUTED_RANK_COLORS):
+        return PRECOMPUTED_RANK_COLORS[rank_int - 1]
+    return RANK_COLORS[(rank_int - 1) % len(RANK_COLORS)]
+
+def build_bar_fig(df, y_column, title, y_label, hover_columns, color_map):
+    """
+    ルームごとの棒グラフを作成する。
+    plotly.express を経由せず、色やホバー情報を配列で渡して go.Bar を直接組み立てる。
+    """
+    names = df["ルーム名"].to_numpy()
+    hover_lines = "".join(f"<br>{col}=%{{customdata[{i}]}}" for i, col in enumerate(hover_columns))
+    fig = go.Figure(go.Bar(
+        x=names, y=df[y_column].to_numpy(),
+        marker_color=[color_map.get(name, "#A9A9A9") for name in names],
+        customdata=df[hover_columns].to_numpy(),
+        hovertemplate=f"ルーム名=%{{x}}<br>{y_label}=%{{y}}{hover_lines}<extra></extra>"
+    ))
+    fig.update_layout(title=title, xaxis_title="ルーム名", yaxis_title=y_label, uirevision="const")
+    return fig
+
+def make_points_fig(df, color_map):
+    """各ルームの現在のポイントの棒グラフを作成する"""
+    return build_bar_fig(df, "現在のポイント", "各ルームの現在のポイント", "ポイント",
+                         ["現在の順位", "上位とのポイント差", "下位とのポイント差"], color_map)
+
+def make_gap_fig(df, gap_column, title, color_map):
+    """上位・下位とのポイント差の棒グラフを作成する"""
+    return build_bar_fig(df, gap_column, title, "ポイント差", ["現在の順位", "現在のポイント"], color_map)
     
+# ルームごとのランキング情報が連続してこの回数取れなかったイベントは、一定時間ルームごとの取得を止める
+BROKEN_EVENT_MISSES = 3
+BROKEN_EVENT_TTL = 300
+
+# セッション内でイベントごとの参加者情報を使い回す秒数（get_event_ranking_with_room_id のキャッシュと同じ）
+ROOM_MAP_TTL = 300
+
+def clear_broken_event():
+    """ルームごとのランキング情報が取れないイベントの判定をすべて取り消す（ルームの選択が変わったときなど）"""
+    st.session_state.broken_event = {}
+    st.session_state.broken_event_misses = {}
+
+def reset_event_selection():
+    """
+    イベントの選択が変わったときに、ルーム選択とダッシュボードの状態を初期化する。
+    selectbox の on_change から呼ばれるため、初期化のためだけに再実行する必要はない。
+    """
+    st.session_state.selected_event_name = st.session_state.event_selector
+    st.session_state.room_map_data = None
+    st.session_state.selected_room_names = []
+    st.session_state.multiselect_default_value = []
+    st.session_state.multiselect_key_counter += 1
+    # 「上位10ルームまでを選択」のチェックボックスのキーが存在すればFalseに設定
+    if 'select_top_10_checkbox' in st.session_state:
+        st.session_state.select_top_10_checkbox = False
+    st.session_state.show_dashboard = False
+    clear_broken_event()
+
 def main():
     st.markdown("<h1 style='font-size:2.5em;'>🎤 SHOWROOM Event Dashboard</h1>", unsafe_allow_html=True)
     st.write("イベント順位やポイント、ポイント差、スペシャルギフトの履歴、必要ギフト数などが、リアルタイムで可視化できるツールです。")
@@ -269,7 +625,7 @@ def main():
         if st.button("認証する"):
             if input_room_id:  # 入力が空でない場合のみ
                 try:
-                    response = requests.get(ROOM_LIST_URL, timeout=5)
+                    response = SESSION.get(ROOM_LIST_URL, timeout=5)
                     response.raise_for_status()
                     room_df = pd.read_csv(io.StringIO(response.text), header=None)
 
@@ -303,9 +659,20 @@ def main():
         st.session_state.multiselect_key_counter = 0
     if "show_dashboard" not in st.session_state:
         st.session_state.show_dashboard = False
+    if "broken_event_misses" not in st.session_state:
+        clear_broken_event()
+    if "room_map_by_event" not in st.session_state:
+        st.session_state.room_map_by_event = {}
 
     st.markdown("<h2 style='font-size:2em;'>1. イベントを選択</h2>", unsafe_allow_html=True)
-    events = get_events()
+    try:
+        events = get_events()
+    except requests.exceptions.RequestException as e:
+        st.error(f"イベントデータ取得中にエラーが発生しました: {e}")
+        return
+    except ValueError as e:
+        st.error(f"APIからのJSONデコードに失敗しました: {e}")
+        return
     if not events:
         st.warning("表示可能なイベントが見つかりませんでした。")
         return
@@ -313,7 +680,7 @@ def main():
     event_options = {event['event_name']: event for event in events}
     selected_event_name = st.selectbox(
         "イベント名を選択してください:", 
-        options=list(event_options.keys()), key="event_selector")
+        options=event_options, key="event_selector", on_change=reset_event_selection)
     
     st.markdown(
         "<p style='font-size:12px; margin: -10px 0px 20px 0px; color:#a1a1a1;'>※ランキング型イベントが対象になります。ただし、ブロック型は対象外になります。<br />※終了済みイベントのポイント表示は、イベント終了日の翌日12:00頃までは「集計中」となり、その後ポイントが表示され、24時間経過するとクリアされます（0表示になります）。<br />※終了済みイベントは、イベント終了日の約1ヶ月後を目処にイベント一覧の選択対象から削除されます。</p>",
@@ -326,28 +693,38 @@ def main():
 
     selected_event_data = event_options.get(selected_event_name)
     event_url = f"https://www.showroom-live.com/event/{selected_event_data.get('event_url_key')}"
-    started_at_dt = datetime.datetime.fromtimestamp(selected_event_data.get('started_at'), JST)
-    ended_at_dt = datetime.datetime.fromtimestamp(selected_event_data.get('ended_at'), JST)
-    event_period_str = f"{started_at_dt.strftime('%Y/%m/%d %H:%M')} - {ended_at_dt.strftime('%Y/%m/%d %H:%M')}"
+    selected_event_key = selected_event_data.get('event_url_key', '')
+    selected_event_id = selected_event_data.get('event_id')
+    # 開始・終了日時と期間の表示文字列はイベントごとに一度だけ計算し、自動更新の間は使い回す
+    if st.session_state.get('event_meta_id') != selected_event_id:
+        started_at_dt = datetime.datetime.fromtimestamp(selected_event_data.get('started_at'), JST)
+        ended_at_dt = datetime.datetime.fromtimestamp(selected_event_data.get('ended_at'), JST)
+        event_period_str = f"{started_at_dt.strftime('%Y/%m/%d %H:%M')} - {ended_at_dt.strftime('%Y/%m/%d %H:%M')}"
+        st.session_state.event_meta = (ended_at_dt, int(ended_at_dt.timestamp() * 1000), event_period_str)
+        st.session_state.event_meta_id = selected_event_id
+    ended_at_dt, ended_at_ms, event_period_str = st.session_state.event_meta
     st.info(f"選択されたイベント: **{selected_event_name}**")
 
     st.markdown("<h2 style='font-size:2em;'>2. 比較したいルームを選択</h2>", unsafe_allow_html=True)
-    selected_event_key = selected_event_data.get('event_url_key', '')
-    selected_event_id = selected_event_data.get('event_id')
 
-    # イベントを変更した場合、「上位10ルームまでを選択」のチェックボックスも初期化する
-    if st.session_state.selected_event_name != selected_event_name or st.session_state.room_map_data is None:
-        with st.spinner('イベント参加者情報を取得中...'):
-            st.session_state.room_map_data = get_event_ranking_with_room_id(selected_event_key, selected_event_id)
-        st.session_state.selected_event_name = selected_event_name
-        st.session_state.selected_room_names = []
-        st.session_state.multiselect_default_value = []
-        st.session_state.multiselect_key_counter += 1
-        # チェックボックスのキーが存在すればFalseに設定
-        if 'select_top_10_checkbox' in st.session_state:
-            st.session_state.select_top_10_checkbox = False
-        st.session_state.show_dashboard = False
-        st.rerun()
+    # 利用者の操作以外（イベント一覧の更新など）で選択が変わった場合も同じように初期化する
+    if st.session_state.selected_event_name != selected_event_name:
+        reset_event_selection()
+    if st.session_state.room_map_data is None:
+        # 一度取得したイベントに戻った場合は、ROOM_MAP_TTL 秒の間はセッション内の結果を使い回す
+        fetched_at, room_map_data = st.session_state.room_map_by_event.get(selected_event_id, (0, None))
+        if room_map_data is None or time.time() - fetched_at > ROOM_MAP_TTL:
+            with st.spinner('イベント参加者情報を取得中...'):
+                room_map_data = get_event_ranking_with_room_id(selected_event_key, selected_event_id)
+            # 取得し直すついでに、期限切れのイベントの参加者情報をセッションから捨てる
+            now = time.time()
+            st.session_state.room_map_by_event = {
+                event_id: entry for event_id, entry in st.session_state.room_map_by_event.items()
+                if now - entry[0] <= ROOM_MAP_TTL
+            }
+            if room_map_data:
+                st.session_state.room_map_by_event[selected_event_id] = (now, room_map_data)
+        st.session_state.room_map_data = room_map_data
 
     room_count_text = ""
     if st.session_state.room_map_data:
@@ -364,8 +741,12 @@ def main():
             "上位10ルームまでを選択（**※チェックされている場合はこちらが優先されます**）", 
             key="select_top_10_checkbox")
         room_map = st.session_state.room_map_data
-        sorted_rooms = sorted(room_map.items(), key=lambda item: item[1].get('point', 0), reverse=True)
-        room_options = [room[0] for room in sorted_rooms]
+        # ポイント順の並びは参加者情報を取得し直したときだけ作り直し、再実行のたびにソートしない
+        if st.session_state.get("room_options_source") is not room_map:
+            sorted_rooms = sorted(room_map.items(), key=lambda item: item[1].get('point') or 0, reverse=True)
+            st.session_state.room_options = [room[0] for room in sorted_rooms]
+            st.session_state.room_options_source = room_map
+        room_options = st.session_state.room_options
         top_10_rooms = room_options[:10]
         selected_room_names_temp = st.multiselect(
             "比較したいルームを選択 (複数選択可):", options=room_options,
@@ -381,6 +762,7 @@ def main():
         else:
             st.session_state.selected_room_names = selected_room_names_temp
             st.session_state.multiselect_default_value = selected_room_names_temp
+        clear_broken_event()
         st.session_state.show_dashboard = True
         st.rerun()
     
@@ -391,6 +773,10 @@ def main():
 
             st.markdown("<h2 style='font-size:2em;'>3. リアルタイムダッシュボード</h2>", unsafe_allow_html=True)
             st.info("7秒ごとに自動更新されます。")
+            # 途中で処理が止まっても自動更新が途切れないよう、ダッシュボードの先頭でタイマーを設定する
+            st_autorefresh(interval=7000, limit=None, key="data_refresh")
+            # 配信中ルームの情報は、期間表示の描画や終了後ランキングの取得と並行して取り寄せておく
+            prefetch_onlives_rooms()
 
             with st.container(border=True):
                         col1, col2 = st.columns([1, 1])
@@ -403,7 +789,7 @@ def main():
                             st.components.v1.html(f"""
                             <div style="font-weight: bold; font-size: 1.5rem; color: #333333; line-height: 1.2; padding-bottom: 15px;">残り時間</div>
                             <div style="font-weight: bold; font-size: 1.1rem; line-height: 1.2;">
-                                <span id="sr_countdown_timer_in_col" style="color: #4CAF50;" data-end="{int(ended_at_dt.timestamp() * 1000)}">計算中...</span>
+                                <span id="sr_countdown_timer_in_col" style="color: #4CAF50;" data-end="{ended_at_ms}">計算中...</span>
                             </div>
                             </div>
                             <script>
@@ -470,7 +856,7 @@ def main():
                     if final_ranking_map:
                         for name, data in final_ranking_map.items():
                             if 'room_id' in data:
-                                final_ranking_data[data['room_id']] = {
+                                final_ranking_data[int(data['room_id'])] = {
                                     'rank': data.get('rank'), 'point': data.get('point')
                                 }
                     else:
@@ -478,32 +864,61 @@ def main():
 
             onlives_rooms = get_onlives_rooms()
 
-            data_to_display = []
+            # 選択中ルームの「ルーム名 → ルームID」対応表を一度だけ作り、以降の探索と int 変換を省く
+            selected_room_ids = {
+                name: int(st.session_state.room_map_data[name]['room_id'])
+                for name in st.session_state.selected_room_names
+                if name in st.session_state.room_map_data
+            }
+
+            # 表示データは列ごとのリストに直接積み、最後に一度だけ DataFrame を作る
+            live_marks, names, ranks, points, upper_gaps, lower_gaps, started_ats = [], [], [], [], [], [], []
             if st.session_state.selected_room_names:
                 premium_live_rooms = [
-                    name for name in st.session_state.selected_room_names
-                    if st.session_state.room_map_data and name in st.session_state.room_map_data and
-                    int(st.session_state.room_map_data[name]['room_id']) in onlives_rooms and
-                    onlives_rooms.get(int(st.session_state.room_map_data[name]['room_id']), {}).get('premium_room_type') == 1
+                    name for name, room_id in selected_room_ids.items()
+                    if onlives_rooms.get(room_id, {}).get('premium_room_type') == 1
                 ]
 
                 if premium_live_rooms:
                     room_names_str = '、'.join([f"'{name}'" for name in premium_live_rooms])
                     st.info(f"{room_names_str} は、プレミアムライブのため、ポイントおよびスペシャルギフト履歴情報は取得できません。")
 
-                for room_name in st.session_state.selected_room_names:
+                # 各ルームのイベント情報はループに入る前にまとめて並列取得しておく
+                room_statuses = {}
+                # 判定には期限があり、期限が切れたら再びルームごとの取得を試す
+                is_broken_event = time.time() < st.session_state.broken_event.get(selected_event_id, 0)
+                if not is_event_ended and is_broken_event:
+                    st.warning("このイベントはルームごとのランキング情報を取得できないため、取得をスキップしています。")
+                elif not is_event_ended:
+                    # 同じルームIDは一度だけ取得する
+                    room_statuses = get_room_statuses(tuple(sorted({
+                        room_id for room_id in selected_room_ids.values()
+                        if onlives_rooms.get(room_id, {}).get('premium_room_type') != 1
+                    })))
+                    # 正常に取得できた応答のどれにもランキング情報がない更新が BROKEN_EVENT_MISSES 回続いたら、
+                    # BROKEN_EVENT_TTL 秒の間このイベントではルームごとの取得を行わない
+                    if room_statuses and all(status is None for status in room_statuses.values()):
+                        misses = st.session_state.broken_event_misses.get(selected_event_id, 0) + 1
+                        if misses >= BROKEN_EVENT_MISSES:
+                            st.session_state.broken_event[selected_event_id] = time.time() + BROKEN_EVENT_TTL
+                            misses = 0
+                        st.session_state.broken_event_misses[selected_event_id] = misses
+                    elif room_statuses:
+                        st.session_state.broken_event_misses.pop(selected_event_id, None)
+
+                for room_name in dict.fromkeys(st.session_state.selected_room_names):
                     try:
-                        if room_name not in st.session_state.room_map_data:
+                        if room_name not in selected_room_ids:
                             st.error(f"選択されたルーム名 '{room_name}' が見つかりません。リストを更新してください。")
                             continue
                         
-                        room_id = st.session_state.room_map_data[room_name]['room_id']
+                        room_id = selected_room_ids[room_name]
                         rank, point, upper_gap, lower_gap = 'N/A', 'N/A', 'N/A', 'N/A'
                         
-                        is_live = int(room_id) in onlives_rooms
+                        is_live = room_id in onlives_rooms
                         is_premium_live = False
                         if is_live:
-                            live_info = onlives_rooms.get(int(room_id))
+                            live_info = onlives_rooms.get(room_id)
                             if live_info and live_info.get('premium_room_type') == 1:
                                 is_premium_live = True
 
@@ -512,20 +927,18 @@ def main():
 
                             started_at_str = ""
                             if is_live:
-                                started_at_ts = onlives_rooms.get(int(room_id), {}).get('started_at')
+                                started_at_ts = onlives_rooms.get(room_id, {}).get('started_at')
                                 if started_at_ts:
                                     started_at_dt = datetime.datetime.fromtimestamp(started_at_ts, JST)
                                     started_at_str = started_at_dt.strftime("%Y/%m/%d %H:%M")
 
-                            data_to_display.append({
-                                "配信中": "🔴",
-                                "ルーム名": room_name,
-                                "現在の順位": rank,
-                                "現在のポイント": "N/A",
-                                "上位とのポイント差": "N/A",
-                                "下位とのポイント差": "N/A",
-                                "配信開始時間": started_at_str
-                            })
+                            live_marks.append("🔴")
+                            names.append(room_name)
+                            ranks.append(rank)
+                            points.append("N/A")
+                            upper_gaps.append("N/A")
+                            lower_gaps.append("N/A")
+                            started_ats.append(started_at_str)
                             continue
                         
                         if is_event_ended:
@@ -537,88 +950,76 @@ def main():
                                 st.warning(f"ルーム名 '{room_name}' の最終ランキング情報が見つかりませんでした。")
                                 continue
                         else:
-                            room_info = get_room_event_info(room_id)
-                            if not isinstance(room_info, dict):
+                            if is_broken_event:
+                                continue
+                            if room_id not in room_statuses:
                                 st.warning(f"ルームID {room_id} のデータが不正な形式です。スキップします。")
                                 continue
                             
-                            rank_info = None
-                            if 'ranking' in room_info and isinstance(room_info['ranking'], dict):
-                                rank_info = room_info['ranking']
-                            elif 'event_and_support_info' in room_info and isinstance(room_info['event_and_support_info'], dict):
-                                event_info = room_info['event_and_support_info']
-                                if 'ranking' in event_info and isinstance(event_info['ranking'], dict):
-                                    rank_info = event_info['ranking']
-                            elif 'event' in room_info and isinstance(room_info['event'], dict):
-                                event_data = room_info['event']
-                                if 'ranking' in event_data and isinstance(event_data['ranking'], dict):
-                                    rank_info = event_data['ranking']
-
-                            if rank_info and 'point' in rank_info:
-                                rank = rank_info.get('rank', 'N/A')
-                                point = rank_info.get('point', 'N/A')
-                                upper_gap = rank_info.get('upper_gap', 'N/A')
-                                lower_gap = rank_info.get('lower_gap', 'N/A')
-                            else:
+                            status = room_statuses[room_id]
+                            if status is None:
                                 st.warning(f"ルーム名 '{room_name}' のランキング情報が不完全です。スキップします。")
                                 continue
+                            rank, point, upper_gap, lower_gap = status.rank, status.point, status.upper_gap, status.lower_gap
                         
                         started_at_str = ""
                         if is_live:
-                            started_at_ts = onlives_rooms.get(int(room_id), {}).get('started_at')
+                            started_at_ts = onlives_rooms.get(room_id, {}).get('started_at')
                             if started_at_ts:
                                 started_at_dt = datetime.datetime.fromtimestamp(started_at_ts, JST)
                                 started_at_str = started_at_dt.strftime("%Y/%m/%d %H:%M")
 
-                        data_to_display.append({
-                            "配信中": "🔴" if is_live else "", "ルーム名": room_name,
-                            "現在の順位": rank, "現在のポイント": point,
-                            "上位とのポイント差": upper_gap, "下位とのポイント差": lower_gap,
-                            "配信開始時間": started_at_str
-                        })
+                        live_marks.append("🔴" if is_live else "")
+                        names.append(room_name)
+                        ranks.append(rank)
+                        points.append(point)
+                        upper_gaps.append(upper_gap)
+                        lower_gaps.append(lower_gap)
+                        started_ats.append(started_at_str)
                     except Exception as e:
                         st.error(f"データ処理中に予期せぬエラーが発生しました（ルーム名: {room_name}）。エラー: {e}")
                         continue
 
-            if data_to_display:
-                df = pd.DataFrame(data_to_display)
+            # 表示できるルームがない場合も、以降の処理のために空の DataFrame を用意しておく
+            df = pd.DataFrame()
+            if names:
+                df = pd.DataFrame({
+                    "配信中": live_marks, "ルーム名": names,
+                    "現在の順位": ranks, "現在のポイント": points,
+                    "上位とのポイント差": upper_gaps, "下位とのポイント差": lower_gaps,
+                    "配信開始時間": started_ats
+                })
+                
+                # 順位は数値に変換し、並べ替えはここで一度だけ行う
+                df['現在の順位'] = pd.to_numeric(df['現在の順位'], errors='coerce')
+                if is_event_ended:
+                    # 終了済み（集計中を含む）の場合は、順位が0より大きいルームを優先してソートする
+                    df['has_valid_rank'] = df['現在の順位'] > 0
+                    df = df.sort_values(by=['has_valid_rank', '現在の順位'], ascending=[False, True], na_position='last').reset_index(drop=True)
+                    df = df.drop(columns=['has_valid_rank'])
+                else:
+                    df = df.sort_values(by='現在の順位', ascending=True, na_position='last').reset_index(drop=True)
                 
                 if is_aggregating:
                     # 集計中の場合はポイントを「集計中」とし、差の計算は行わない
                     df['現在のポイント'] = '集計中'
                     df['上位とのポイント差'] = 'N/A'
                     df['下位とのポイント差'] = 'N/A'
-                    df['現在の順位'] = pd.to_numeric(df['現在の順位'], errors='coerce')
-                    
-                    # ▼▼▼ 修正箇所 ▼▼▼
-                    # 順位が0より大きいルームを優先してソートするロジックを適用
-                    df['has_valid_rank'] = df['現在の順位'] > 0
-                    df = df.sort_values(by=['has_valid_rank', '現在の順位'], ascending=[False, True], na_position='last').reset_index(drop=True)
-                    df = df.drop(columns=['has_valid_rank'])
-                    # ▲▲▲ 修正箇所 ▲▲▲
                     
                     started_at_column = df['配信開始時間']
                     df = df.drop(columns=['配信開始時間'])
                     df.insert(1, '配信開始時間', started_at_column)
                 else:
                     # 通常時の処理
-                    df['現在の順位'] = pd.to_numeric(df['現在の順位'], errors='coerce')
                     df['現在のポイント'] = pd.to_numeric(df['現在のポイント'], errors='coerce')
-                    
-                    if is_event_ended:
-                        df['has_valid_rank'] = df['現在の順位'] > 0
-                        df = df.sort_values(by=['has_valid_rank', '現在の順位'], ascending=[False, True], na_position='last').reset_index(drop=True)
-                        df = df.drop(columns=['has_valid_rank'])
-                    else:
-                        df = df.sort_values(by='現在の順位', ascending=True, na_position='last').reset_index(drop=True)
 
                     live_status = df['配信中']
                     df = df.drop(columns=['配信中'])
                     
-                    df['上位とのポイント差'] = (df['現在のポイント'].shift(1) - df['現在のポイント']).abs().fillna(0).astype(int)
-                    if not df.empty:
-                        df.at[0, '上位とのポイント差'] = 0
-                    df['下位とのポイント差'] = (df['現在のポイント'].shift(-1) - df['現在のポイント']).abs().fillna(0).astype(int)
+                    # 隣り合う順位とのポイント差は numpy で一度だけ計算し、先頭・末尾は 0 とする（ポイント不明も 0）
+                    point_gaps = np.nan_to_num(np.abs(np.diff(df['現在のポイント'].to_numpy(dtype=float))))
+                    df['上位とのポイント差'] = np.concatenate(([0], point_gaps)).astype(np.int64)
+                    df['下位とのポイント差'] = np.concatenate((point_gaps, [0])).astype(np.int64)
                     df.insert(0, '配信中', live_status)
                     
                     started_at_column = df['配信開始時間']
@@ -657,8 +1058,8 @@ def main():
                         df_to_format = df.copy()
                         
                         if not is_aggregating:
-                            for col in ['現在のポイント', '上位とのポイント差', '下位とのポイント差']:
-                                df_to_format[col] = pd.to_numeric(df_to_format[col], errors='coerce').fillna(0).astype(int)
+                            # ポイント差の列は計算時点で整数になっているため、ポイント列のみ変換する
+                            df_to_format['現在のポイント'] = df_to_format['現在のポイント'].fillna(0).astype(int)
                             
                             styled_df = df_to_format.style.apply(highlight_rows, axis=1).highlight_max(axis=0, subset=['現在のポイント']).format(
                                 {'現在のポイント': '{:,}', '上位とのポイント差': '{:,}', '下位とのポイント差': '{:,}'})
@@ -720,8 +1121,8 @@ def main():
             live_rooms_data = []
             if not df.empty and st.session_state.room_map_data:
                 selected_live_room_ids = {
-                    int(st.session_state.room_map_data[row['ルーム名']]['room_id']) for index, row in df.iterrows() 
-                    if '配信中' in row and row['配信中'] == '🔴' and onlives_rooms.get(int(st.session_state.room_map_data[row['ルーム名']]['room_id']), {}).get('premium_room_type') != 1
+                    selected_room_ids[row['ルーム名']] for index, row in df.iterrows() 
+                    if '配信中' in row and row['配信中'] == '🔴' and onlives_rooms.get(selected_room_ids[row['ルーム名']], {}).get('premium_room_type') != 1
                 }
                 rooms_to_delete = [room_id for room_id in st.session_state.gift_log_cache if int(room_id) not in selected_live_room_ids]
                 for room_id in rooms_to_delete:
@@ -729,10 +1130,10 @@ def main():
                 
                 for index, row in df.iterrows():
                     room_name = row['ルーム名']
-                    if room_name in st.session_state.room_map_data:
-                        room_id = st.session_state.room_map_data[room_name]['room_id']
-                        if int(room_id) in onlives_rooms:
-                            if onlives_rooms.get(int(room_id), {}).get('premium_room_type') != 1:
+                    if room_name in selected_room_ids:
+                        room_id = selected_room_ids[room_name]
+                        if room_id in onlives_rooms:
+                            if onlives_rooms.get(room_id, {}).get('premium_room_type') != 1:
                                 live_rooms_data.append({
                                     "room_name": room_name, "room_id": room_id, "rank": row['現在の順位']
                                 })
@@ -743,13 +1144,21 @@ def main():
             
             room_html_list = []
             if len(live_rooms_data) > 0:
+                # プレミアムライブ以外の配信中ルームのギフト情報は、描画の前にまとめて並列取得しておく
+                gift_room_ids = tuple(sorted({
+                    room_data['room_id'] for room_data in live_rooms_data
+                    if onlives_rooms.get(room_data['room_id'], {}).get('premium_room_type') != 1
+                }))
+                gift_logs = get_and_update_gift_logs(gift_room_ids)
+                gift_lists = get_gift_lists(gift_room_ids)
+
                 for room_data in live_rooms_data:
                     room_name = room_data['room_name']
                     room_id = room_data['room_id']
                     rank = room_data.get('rank', 'N/A')
                     rank_color = get_rank_color(rank)
 
-                    if onlives_rooms.get(int(room_id), {}).get('premium_room_type') == 1:
+                    if onlives_rooms.get(room_id, {}).get('premium_room_type') == 1:
                         html_content = f"""
                         <div class="room-container">
                             <div class="ranking-label" style="background-color: {rank_color};">{rank}位</div>
@@ -762,9 +1171,9 @@ def main():
                         room_html_list.append(html_content)
                         continue
 
-                    if int(room_id) in onlives_rooms:
-                        gift_log = get_and_update_gift_log(room_id)
-                        gift_list_map = get_gift_list(room_id)
+                    if room_id in onlives_rooms:
+                        gift_log = gift_logs.get(room_id, [])
+                        gift_list_map = gift_lists.get(room_id, {})
                         
                         html_content = f"""
                         <div class="room-container">
@@ -778,7 +1187,7 @@ def main():
                         if gift_log:
                             for log in gift_log:
                                 gift_id = log.get('gift_id')
-                                gift_info = gift_list_map.get(str(gift_id), {})
+                                gift_info = gift_list_map.get(gift_id, {})
                                 gift_point = gift_info.get('point', 0)
                                 gift_count = log.get('num', 0)
                                 total_point = gift_point * gift_count
@@ -826,10 +1235,17 @@ def main():
                 # 順位ラベル付き表示を作成
                 room_rank_map = {}
                 df_rank_map = {}
+                df_lower_gap_map = {}
                 if 'df' in locals() and not df.empty and 'ルーム名' in df.columns and '現在の順位' in df.columns:
                     for _, row in df.iterrows():
                         if pd.notna(row['現在の順位']):
                             df_rank_map[row['ルーム名']] = int(row['現在の順位'])
+                        lg = row.get('下位とのポイント差')
+                        if pd.notna(lg):
+                            try:
+                                df_lower_gap_map[row['ルーム名']] = int(lg)
+                            except (ValueError, TypeError):
+                                pass
 
                 for rn in room_options_all:
                     if rn in df_rank_map:  # df の順位を優先
@@ -889,21 +1305,9 @@ def main():
                         needed_points_to_overtake = max(0, enemy_point - target_point + 1)
                         needed = max(0, needed_points_to_overtake)
 
-                    # 順位・下位差取得
-                    target_rank = None
-                    target_lower_gap = None
-                    try:
-                        if 'df' in locals() and not df.empty and 'ルーム名' in df.columns:
-                            row = df[df['ルーム名'] == selected_target_room]
-                            if not row.empty:
-                                if not pd.isna(row.iloc[0].get('現在の順位')):
-                                    target_rank = int(row.iloc[0].get('現在の順位'))
-                                if '下位とのポイント差' in row.columns:
-                                    lg = row.iloc[0].get('下位とのポイント差')
-                                    if not pd.isna(lg):
-                                        target_lower_gap = int(lg)
-                    except:
-                        pass
+                    # 順位・下位差取得（df を走査せず、ルーム名をキーにした辞書から引く）
+                    target_rank = df_rank_map.get(selected_target_room)
+                    target_lower_gap = df_lower_gap_map.get(selected_target_room)
                     if target_rank is None:
                         target_rank = st.session_state.room_map_data.get(selected_target_room, {}).get('rank')
 
@@ -1066,37 +1470,23 @@ def main():
 
                 with points_container:
                     if '現在のポイント' in df.columns:
-                        fig_points = px.bar(
-                            df, x="ルーム名", y="現在のポイント", title="各ルームの現在のポイント", color="ルーム名",
-                            color_discrete_map=color_map, hover_data=["現在の順位", "上位とのポイント差", "下位とのポイント差"],
-                            labels={"現在のポイント": "ポイント", "ルーム名": "ルーム名"}
-                        )
+                        fig_points = make_points_fig(
+                            df[["ルーム名", "現在のポイント", "現在の順位", "上位とのポイント差", "下位とのポイント差"]], color_map)
                         st.plotly_chart(fig_points, use_container_width=True, key="points_chart")
-                        fig_points.update_layout(uirevision="const")
 
                     if len(st.session_state.selected_room_names) > 1 and "上位とのポイント差" in df.columns:
-                        df['上位とのポイント差'] = pd.to_numeric(df['上位とのポイント差'], errors='coerce')
-                        fig_upper_gap = px.bar(
-                            df, x="ルーム名", y="上位とのポイント差", title="上位とのポイント差", color="ルーム名",
-                            color_discrete_map=color_map, hover_data=["現在の順位", "現在のポイント"],
-                            labels={"上位とのポイント差": "ポイント差", "ルーム名": "ルーム名"}
-                        )
+                        fig_upper_gap = make_gap_fig(
+                            df[["ルーム名", "上位とのポイント差", "現在の順位", "現在のポイント"]],
+                            "上位とのポイント差", "上位とのポイント差", color_map)
                         st.plotly_chart(fig_upper_gap, use_container_width=True, key="upper_gap_chart")
-                        fig_upper_gap.update_layout(uirevision="const")
 
                     if len(st.session_state.selected_room_names) > 1 and "下位とのポイント差" in df.columns:
-                        df['下位とのポイント差'] = pd.to_numeric(df['下位とのポイント差'], errors='coerce')
-                        fig_lower_gap = px.bar(
-                            df, x="ルーム名", y="下位とのポイント差", title="下位とのポイント差", color="ルーム名",
-                            color_discrete_map=color_map, hover_data=["現在の順位", "現在のポイント"],
-                            labels={"下位とのポイント差": "ポイント差", "ルーム名": "ルーム名"}
-                        )
+                        fig_lower_gap = make_gap_fig(
+                            df[["ルーム名", "下位とのポイント差", "現在の順位", "現在のポイント"]],
+                            "下位とのポイント差", "下位とのポイント差", color_map)
                         st.plotly_chart(fig_lower_gap, use_container_width=True, key="lower_gap_chart")
-                        fig_lower_gap.update_layout(uirevision="const")
             else:
                 st.info("イベントポイント集計中のため、グラフは表示されません。")
-                    
-            st_autorefresh(interval=7000, limit=None, key="data_refresh")
         
     
 if __name__ == "__main__":